@@ -29,7 +29,7 @@ class GithubReleaseSource(Source):
     def configure(self, node):
         self.node_validate(node, ['url', 'repo',
                                   'asset', 'asset_id',
-                                  'unzip', 'rename'] +
+                                  'unzip', 'rename', 'size'] +
                            Source.COMMON_CONFIG_KEYS)
 
         self.load_ref(node)
@@ -56,18 +56,24 @@ class GithubReleaseSource(Source):
             self.url = self.translate_url(self.original_url)
         else:
             self.url = None
+        self.size = self.node_get_member(node, int, 'size', None)
 
     def get_ref(self):
         if self.original_url is None or self.asset_id is None:
             return None
-        return {
+        ref = {
             'url': self.original_url,
             'asset_id': self.asset_id,
         }
+        if self.size is not None:
+            ref['size'] = self.size
+        return ref
 
     def set_ref(self, ref, node):
         node['url'] = self.original_url = ref['url']
         node['asset_id'] = self.asset_id = ref['asset_id']
+        if 'size' in ref:
+            node['size'] = self.size = ref['size']
 
     def track(self):
         # https://api.github.com/repos/REPO/releases/latest
@@ -87,6 +93,7 @@ class GithubReleaseSource(Source):
                 found_ref = {
                     'url': asset['browser_download_url'],
                     'asset_id': str(asset['id']),
+                    'size': asset['size'],
                 }
 
                 break
@@ -95,24 +102,62 @@ class GithubReleaseSource(Source):
             raise SourceError(
                 f'{self}: Did not find any asset for {self.repo} {self.asset}')
 
+        if self.unzip:
+            # The staged size is the extracted one, not the asset size
+            found_ref['size'] = self._track_unzipped_size(found_ref)
+
         return found_ref
 
+    def _track_unzipped_size(self, ref):
+        # The asset is downloaded into the mirror, like fetch does, so it
+        # is not downloaded again to build
+        mirror_file = os.path.join(self._get_mirror_dir(), ref['asset_id'])
+        if os.path.isfile(mirror_file):
+            return self._get_unzipped_size(mirror_file, ref['url'])
+
+        try:
+            with self.tempdir() as tempdir:
+                local_file = self._download(ref['url'], tempdir)
+                # Broken assets never reach the mirror
+                size = self._get_unzipped_size(local_file, ref['url'])
+                if not os.path.isdir(self._get_mirror_dir()):
+                    os.makedirs(self._get_mirror_dir())
+                os.rename(local_file, mirror_file)
+                return size
+        except (urllib.error.URLError,
+                urllib.error.ContentTooShortError,
+                OSError) as e:
+            raise SourceError(f"{self}: Error tracking {ref['url']}: {e}",
+                              temporary=True) from e
+
+    def _get_unzipped_size(self, path, url):
+        try:
+            with zipfile.ZipFile(path, mode='r') as zipf:
+                return sum(info.file_size for info in zipf.infolist())
+        except zipfile.BadZipFile as e:
+            raise SourceError(f"{self}: Cannot read asset {url}: {e}") from e
+
+    def _download(self, url, directory):
+        default_name = os.path.basename(url)
+        request = urllib.request.Request(url)
+        request.add_header('Accept', '*/*')
+        request.add_header('User-Agent', 'BuildStream/1')
+
+        urlopen = urllib.request.urlopen(request)
+        with contextlib.closing(urlopen) as response:
+            info = response.info()
+            filename = info.get_filename(default_name)
+            filename = os.path.basename(filename)
+            local_file = os.path.join(directory, filename)
+            with open(local_file, 'wb') as dest:
+                shutil.copyfileobj(response, dest)
+
+        return local_file
+
     def fetch(self):
         try:
             with self.tempdir() as tempdir:
-                default_name = os.path.basename(self.url)
-                request = urllib.request.Request(self.url)
-                request.add_header('Accept', '*/*')
-                request.add_header('User-Agent', 'BuildStream/1')
-
-                urlopen = urllib.request.urlopen(request)
-                with contextlib.closing(urlopen) as response:
-                    info = response.info()
-                    filename = info.get_filename(default_name)
-                    filename = os.path.basename(filename)
-                    local_file = os.path.join(tempdir, filename)
-                    with open(local_file, 'wb') as dest:
-                        shutil.copyfileobj(response, dest)
+                local_file = self._download(self.url, tempdir)
 
                 if not os.path.isdir(self._get_mirror_dir()):
                     os.makedirs(self._get_mirror_dir())
@@ -0,0 +1,490 @@
+#
+#  Copyright EndlessOS Foundation
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Authors:
+#        Daniel Garcia <danigm@endlessos.org>
+
+import os
+import re
+import secrets
+import struct
+import shutil
+import tempfile
+import zlib
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from buildstream import Element, ElementError, Scope, SandboxFlags
+
+# FAT32 on-disk constants used to estimate the image size
+SECTOR_SIZE = 512
+RESERVED_SECTORS = 32
+DIR_ENTRY_SIZE = 32
+# Characters stored in each long file name directory entry
+LFN_CHARS_PER_ENTRY = 13
+
+INDEX_MAGIC = b'EKIMGIDX'
+INDEX_VERSION = 2
+# magic, version, block size, compression level, blocks, compressed size
+INDEX_HEADER = struct.Struct('<8sIIIQQ')
+# uncompressed digest, compressed digest, compressed length
+INDEX_ENTRY = struct.Struct('<16s16sI')
+# Truncated sha256, plenty to identify a block of the image
+DIGEST_SIZE = 16
+# Blocks are compressed in batches of about this size to keep the
+# overhead of the thread pool low with small blocks
+BATCH_SIZE = 1024 * 1024
+
+# Source kinds that record the size they stage in their ref when tracked
+SIZED_KINDS = ('kolibri_channel', 'kolibri_collection',
+               'github_release', 'pypi')
+# Number of contributors reported when the budget is exceeded
+TOP_CONTRIBUTORS = 10
+
+SIZE_UNITS = {
+    '': 1,
+    'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4,
+    'KI': 1024, 'MI': 1024 ** 2, 'GI': 1024 ** 3, 'TI': 1024 ** 4,
+}
+
+
+def _cache_home():
+    return os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+
+
+def _round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+
+def _parse_size(value):
+    # Sizes like 64G or 64GB use the decimal units USB sticks are sold
+    # with, 64Gi or 64GiB are binary
+    match = re.fullmatch(r'\s*(\d+)\s*([KMGT]I?)?B?\s*', value.upper())
+    if match is None:
+        return None
+    return int(match.group(1)) * SIZE_UNITS[match.group(2) or '']
+
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1000:
+            return f'{size:.1f}{unit}' if unit != 'B' else f'{size}B'
+        size /= 1000
+    return f'{size:.1f}TB'
+
+
+def _digest(data):
+    return hashlib.sha256(data).digest()[:DIGEST_SIZE]
+
+
+def _dir_entries(name):
+    # One short entry plus the long file name entries
+    return 1 + -(-len(name) // LFN_CHARS_PER_ENTRY)
+
+
+def _compress_blocks(blocks, level, previous, previous_fd):
+    # Each block is an independent gzip member. Concatenated members
+    # form a standard gzip stream, so any gzip implementation can
+    # decompress the result, and a block can be reused as is when its
+    # uncompressed content did not change.
+    results = []
+    for data in blocks:
+        digest = _digest(data)
+        if digest in previous:
+            offset, length, member_digest = previous[digest]
+            member = os.pread(previous_fd, length, offset)
+            # Never trust the cached image blindly
+            if _digest(member) == member_digest:
+                results.append((digest, member, member_digest, True))
+                continue
+
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        member = compressor.compress(data) + compressor.flush()
+        results.append((digest, member, _digest(member), False))
+
+    return results
+
+
+class ImageElement(Element):
+    BST_FORBID_SOURCES = True
+
+    def configure(self, node):
+        self.node_validate(node, ['trees', 'filename', 'label',
+                                  'cluster-size', 'headroom',
+                                  'block-size', 'compression-level',
+                                  'threads', 'block-cache', 'budget'])
+
+        self.trees = self.node_get_member(node, list, 'trees', [])
+        if not self.trees:
+            raise ElementError(f'{self}: Missing trees')
+
+        self.filename = self.node_get_member(node, str, 'filename',
+                                             'endless-key.img')
+        self.label = self.node_get_member(node, str, 'label', 'ENDLESSKEY')
+        self.cluster_size = self.node_get_member(node, int, 'cluster-size',
+                                                 32768)
+        if self.cluster_size % SECTOR_SIZE:
+            raise ElementError(
+                f'{self}: cluster-size must be a multiple of {SECTOR_SIZE}')
+        self.headroom = self.node_get_member(node, int, 'headroom', 5)
+        # Files start on cluster boundaries, blocks that evenly divide a
+        # cluster still match the cached image after files move
+        self.block_size = self.node_get_member(node, int, 'block-size',
+                                               self.cluster_size)
+        if self.block_size <= 0:
+            raise ElementError(f'{self}: block-size must be positive')
+        if self.cluster_size % self.block_size:
+            raise ElementError(
+                f'{self}: cluster-size must be a multiple of block-size')
+        self.level = self.node_get_member(node, int, 'compression-level', 6)
+        if not 0 <= self.level <= 9:
+            raise ElementError(
+                f'{self}: compression-level must be between 0 and 9')
+        self.threads = self.node_get_member(node, int, 'threads', 0)
+        self.block_cache = self.node_get_member(node, str, 'block-cache',
+                                                None)
+
+        budget = self.node_subst_member(node, 'budget', '0')
+        self.budget = _parse_size(budget)
+        if self.budget is None:
+            raise ElementError(f'{self}: Invalid budget {budget}')
+
+    def preflight(self):
+        for tree in self.trees:
+            if self.search(Scope.BUILD, tree) is None:
+                raise ElementError(
+                    f'{self}: {tree} must be a build dependency')
+
+        # Preflight runs whenever the element is loaded, also to track
+        # or show it, so this early estimate only warns. Failing here
+        # would also stop the track that refreshes the sizes.
+        if self.budget:
+            self._check_budget()
+
+    def get_unique_key(self):
+        # threads and block-cache only affect how fast the image is
+        # built, never its content
+        return {
+            'trees': self.trees,
+            'filename': self.filename,
+            'label': self.label,
+            'cluster-size': self.cluster_size,
+            'headroom': self.headroom,
+            'block-size': self.block_size,
+            'compression-level': self.level,
+        }
+
+    def configure_sandbox(self, sandbox):
+        build_root = self.get_variable('build-root')
+        install_root = self.get_variable('install-root')
+
+        sandbox.mark_directory(build_root)
+        sandbox.mark_directory(install_root)
+        sandbox.set_work_directory(build_root)
+        sandbox.set_environment(self.get_environment())
+
+    def stage(self, sandbox):
+        tree_names = set(self.trees)
+
+        with self.timed_activity('Staging tools', silent_nested=True):
+            for dep in self.dependencies(Scope.BUILD, recurse=False):
+                if dep.name not in tree_names:
+                    dep.stage_dependency_artifacts(sandbox, Scope.RUN)
+
+        # Every tree goes to its own directory so it can be copied into
+        # the image filesystem straight from where it was staged
+        for i, tree in enumerate(self.trees):
+            with self.timed_activity(f'Staging {tree}', silent_nested=True):
+                dep = self.search(Scope.BUILD, tree)
+                dep.stage_dependency_artifacts(sandbox, Scope.RUN,
+                                               path=self._get_tree_dir(i))
+
+    def assemble(self, sandbox):
+        rootdir = sandbox.get_directory()
+        build_root = self.get_variable('build-root')
+        install_root = self.get_variable('install-root')
+
+        image = os.path.join(build_root, self.filename)
+        host_image = self._host_path(rootdir, image)
+        host_trees = [self._host_path(rootdir, self._get_tree_dir(i))
+                      for i in range(len(self.trees))]
+
+        size = self._calculate_size(host_trees)
+        if self.budget and size > self.budget:
+            raise ElementError(
+                f'{self}: Image size {_format_size(size)} exceeds the '
+                f'image budget {_format_size(self.budget)}',
+                detail=self._get_budget_detail())
+        with self.timed_activity(f'Creating {size} bytes filesystem'):
+            with open(host_image, 'wb') as f:
+                f.truncate(size)
+            self._run(sandbox, ['mkfs.vfat', '-F', '32',
+                                '-S', str(SECTOR_SIZE),
+                                '-s', str(self.cluster_size // SECTOR_SIZE),
+                                '-n', self.label, image])
+
+        for i, tree in enumerate(self.trees):
+            entries = sorted(os.listdir(host_trees[i]))
+            if not entries:
+                continue
+            tree_dir = self._get_tree_dir(i)
+            sources = [os.path.join(tree_dir, e) for e in entries]
+            with self.timed_activity(f'Copying {tree} into the image'):
+                self._run(sandbox, ['mcopy', '-s', '-p', '-m', '-Q',
+                                    '-i', image] + sources + ['::/'])
+
+        output = self._host_path(rootdir, install_root)
+        os.makedirs(output, exist_ok=True)
+        output = os.path.join(output, f'{self.filename}.gz')
+
+        with self.timed_activity(f'Compressing {self.filename}'):
+            self._compress(host_image, output)
+        os.unlink(host_image)
+
+        return install_root
+
+    def _get_staged_sizes(self):
+        # Returns the sizes recorded by track() in the refs of the
+        # sources staged in the image and the sources without one. Only
+        # import elements stage their sources as they are, what other
+        # elements install cannot be known before building them.
+        contributors = []
+        unknown = []
+        seen = set()
+        for tree in self.trees:
+            dep = self.search(Scope.BUILD, tree)
+            for element in dep.dependencies(Scope.RUN):
+                if element.name in seen:
+                    continue
+                seen.add(element.name)
+                if element.get_kind() != 'import':
+                    continue
+                for source in element.sources():
+                    if source.get_kind() not in SIZED_KINDS:
+                        continue
+                    ref = source.get_ref()
+                    if ref is None or 'size' not in ref:
+                        unknown.append(f'{element.name}: {source}')
+                        continue
+                    contributors.append((ref['size'],
+                                         f'{element.name}: {source}',
+                                         ref.get('channels', [])))
+
+        return contributors, unknown
+
+    def _check_budget(self):
+        contributors, unknown = self._get_staged_sizes()
+        if unknown:
+            self.warn(f'{self}: Unknown size for {len(unknown)} sources, '
+                      'track them to include them in the budget',
+                      detail='\n'.join(unknown))
+
+        staged = sum(size for size, _, _ in contributors)
+        needed = staged + staged * self.headroom // 100
+        if needed <= self.budget:
+            return
+
+        self.warn(
+            f'{self}: Staged size {_format_size(staged)} plus '
+            f'{self.headroom}% headroom exceeds the image budget '
+            f'{_format_size(self.budget)}, the image will likely not fit',
+            detail=self._get_budget_detail(contributors))
+
+    def _get_budget_detail(self, contributors=None):
+        if contributors is None:
+            contributors, _ = self._get_staged_sizes()
+
+        # Channels are reported on their own, they are what is usually
+        # dropped from a collection to make the image fit
+        sizes = []
+        for size, name, channels in contributors:
+            if channels and all('size' in c for c in channels):
+                sizes.extend((c['size'], f'{name} channel {c["id"]}')
+                             for c in channels)
+            else:
+                sizes.append((size, name))
+        sizes.sort(reverse=True)
+
+        detail = ['Biggest contributors:']
+        detail.extend(f'  {_format_size(size):>10}  {name}'
+                      for size, name in sizes[:TOP_CONTRIBUTORS])
+        return '\n'.join(detail)
+
+    def _get_tree_dir(self, index):
+        return os.path.join(self.get_variable('build-root'),
+                            'trees', str(index))
+
+    def _host_path(self, rootdir, path):
+        return os.path.join(rootdir, path.lstrip(os.sep))
+
+    def _run(self, sandbox, command):
+        env = dict(self.get_environment())
+        env['MTOOLS_SKIP_CHECK'] = '1'
+        exitcode = sandbox.run(command, SandboxFlags.ROOT_READ_ONLY, env=env)
+        if exitcode != 0:
+            raise ElementError(
+                f'{self}: Command "{" ".join(command)}" failed '
+                f'with exitcode {exitcode}')
+
+    def _calculate_size(self, host_trees):
+        clusters = 0
+        for tree in host_trees:
+            for root, dirs, files in os.walk(tree):
+                # Plus the . and .. entries
+                entries = sum(_dir_entries(n) for n in dirs + files) + 2
+                dir_size = entries * DIR_ENTRY_SIZE
+                clusters += _round_up(dir_size, self.cluster_size)
+                for name in files:
+                    path = os.path.join(root, name)
+                    if os.path.islink(path):
+                        continue
+                    size = max(os.path.getsize(path), 1)
+                    clusters += _round_up(size, self.cluster_size)
+        clusters //= self.cluster_size
+        # Root directory
+        clusters += 1
+
+        # Two FAT copies with four bytes per cluster
+        fat_size = _round_up((clusters + 2) * 4, SECTOR_SIZE) * 2
+        size = (RESERVED_SECTORS * SECTOR_SIZE + fat_size +
+                clusters * self.cluster_size)
+        size += size * self.headroom // 100
+
+        return _round_up(size, 1024 * 1024)
+
+    def _get_cache_dir(self):
+        if self.block_cache is not None:
+            return self.block_cache
+        return os.path.join(_cache_home(), 'ekbuild', 'image',
+                            self.normal_name)
+
+    def _load_previous(self, cache_dir, previous_fd):
+        # Returns the blocks of the cached image by uncompressed digest
+        previous_index = os.path.join(cache_dir, f'{self.filename}.gz.idx')
+        try:
+            with open(previous_index, 'rb') as f:
+                header = f.read(INDEX_HEADER.size)
+                entries = zlib.decompress(f.read())
+            (magic, version, block_size, level,
+             count, size) = INDEX_HEADER.unpack(header)
+        except (OSError, zlib.error, struct.error):
+            return {}
+
+        if (magic != INDEX_MAGIC or version != INDEX_VERSION or
+                block_size != self.block_size or level != self.level or
+                size != os.fstat(previous_fd).st_size or
+                len(entries) != count * INDEX_ENTRY.size):
+            return {}
+
+        blocks = {}
+        offset = 0
+        for digest, member_digest, length in INDEX_ENTRY.iter_unpack(entries):
+            blocks.setdefault(digest, (offset, length, member_digest))
+            offset += length
+        return blocks
+
+    def _compress(self, source, output):
+        cache_dir = self._get_cache_dir()
+        threads = self.threads or os.cpu_count() or 1
+        batch = max(BATCH_SIZE // self.block_size, 1)
+
+        previous = {}
+        previous_fd = None
+        try:
+            previous_fd = os.open(
+                os.path.join(cache_dir, f'{self.filename}.gz'), os.O_RDONLY)
+            previous = self._load_previous(cache_dir, previous_fd)
+        except OSError:
+            pass
+
+        entries = []
+        reused = 0
+        written = 0
+
+        def write_blocks(dest, results):
+            nonlocal written, reused
+            for digest, member, member_digest, cached in results:
+                dest.write(member)
+                entries.append(INDEX_ENTRY.pack(digest, member_digest,
+                                                len(member)))
+                written += len(member)
+                reused += cached
+
+        try:
+            with open(source, 'rb') as src, \
+                    open(output, 'wb') as dest, \
+                    ThreadPoolExecutor(max_workers=threads) as executor:
+                # Keep a bounded number of batches in flight so memory use
+                # does not depend on the image size
+                pending = deque()
+                while True:
+                    blocks = []
+                    for _ in range(batch):
+                        data = src.read(self.block_size)
+                        if not data:
+                            break
+                        blocks.append(data)
+                    if not blocks:
+                        break
+                    pending.append(executor.submit(_compress_blocks, blocks,
+                                                   self.level, previous,
+                                                   previous_fd))
+                    if len(pending) >= threads * 2:
+                        write_blocks(dest, pending.popleft().result())
+                while pending:
+                    write_blocks(dest, pending.popleft().result())
+        finally:
+            if previous_fd is not None:
+                os.close(previous_fd)
+
+        self.status(f'Compressed {len(entries)} blocks, '
+                    f'reused {reused} from the previous image')
+
+        with open(f'{output}.idx', 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                      self.block_size, self.level,
+                                      len(entries), written))
+            f.write(zlib.compress(b''.join(entries)))
+
+        self._update_cache(cache_dir, output)
+
+    def _update_cache(self, cache_dir, output):
+        # Concurrent builds can replace the cached image and index one
+        # after the other, a block is only reused if its compressed digest
+        # matches the index, so a mismatched pair only costs speed
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for path in (output, f'{output}.idx'):
+                dest = os.path.join(cache_dir, os.path.basename(path))
+                tmp = f'{dest}.{secrets.token_hex(8)}.tmp'
+                try:
+                    os.link(path, tmp)
+                except OSError:
+                    # Copy into a new file, never into an existing one
+                    # that could be linked to the output of another build
+                    fd, tmp = tempfile.mkstemp(dir=cache_dir,
+                                               prefix=os.path.basename(dest),
+                                               suffix='.tmp')
+                    with os.fdopen(fd, 'wb') as f, open(path, 'rb') as src:
+                        shutil.copyfileobj(src, f)
+                os.replace(tmp, dest)
+        except OSError as e:
+            # The cache only speeds up later builds
+            self.warn(f'{self}: Cannot update block cache {cache_dir}: {e}')
+
+
+def setup():
+    return ImageElement
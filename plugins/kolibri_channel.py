@@ -28,6 +28,25 @@ from buildstream import Source, SourceError, utils, Consistency
 STUDIO = 'https://kolibri-content.endlessos.org'
 API = '/api/public/v1/channels/lookup/'
 
+# Bump when the optimization changes, to not reuse older optimized copies
+OPTIMIZE_VERSION = 2
+# Larger pages mean fewer reads on slow USB storage
+OPTIMIZE_PAGE_SIZE = 16384
+# Indexes for the content node queries Kolibri runs when browsing and
+# searching a channel, (name, table, columns). The channel databases
+# already have single column indexes on foreign keys and db_index fields,
+# these are the composite ones they lack.
+OPTIMIZE_INDEXES = [
+    ('ekbuild_contentnode_parent', 'content_contentnode',
+     ['parent_id', 'available', 'lft']),
+    ('ekbuild_contentnode_tree', 'content_contentnode',
+     ['tree_id', 'lft', 'rght']),
+    ('ekbuild_contentnode_kind', 'content_contentnode',
+     ['channel_id', 'kind', 'available']),
+    ('ekbuild_file_contentnode', 'content_file',
+     ['contentnode_id', 'thumbnail']),
+]
+
 
 @dataclass
 class SourceFile:
@@ -38,7 +57,8 @@ class SourceFile:
 
 class KolibriChannelSource(Source):
     def configure(self, node):
-        self.node_validate(node, ['token', 'id', 'version'] +
+        self.node_validate(node, ['token', 'id', 'version', 'size',
+                                  'optimize_db'] +
                            Source.COMMON_CONFIG_KEYS)
 
         self.load_ref(node)
@@ -48,28 +68,39 @@ class KolibriChannelSource(Source):
             raise SourceError(f'{self}: Missing token or id')
 
         self.version = self.node_get_member(node, int, 'version', 1)
+        self.optimize_db = self.node_get_member(node, bool, 'optimize_db',
+                                                False)
 
     def preflight(self):
         pass
 
     def get_unique_key(self):
-        return [self.channel_id, self.version]
+        key = [self.channel_id, self.version]
+        if self.optimize_db:
+            key.append(f'optimize-db-{OPTIMIZE_VERSION}')
+        return key
 
     def load_ref(self, node):
         self.channel_id = self.node_get_member(node, str, 'id', None)
         self.version = self.node_get_member(node, int, 'version', 1)
+        self.size = self.node_get_member(node, int, 'size', None)
 
     def get_ref(self):
         if self.channel_id is None or self.version is None:
             return None
-        return {
+        ref = {
             'id': self.channel_id,
             'version': self.version,
         }
+        if self.size is not None:
+            ref['size'] = self.size
+        return ref
 
     def set_ref(self, ref, node):
         node['id'] = self.channel_id = ref['id']
         node['version'] = self.version = ref['version']
+        if 'size' in ref:
+            node['size'] = self.size = ref['size']
 
     def track(self):
         lookup = self.channel_id or self.token
@@ -87,7 +118,42 @@ class KolibriChannelSource(Source):
             raise SourceError(
                 f'{self}: Cannot find any channel for {lookup}')
 
-        return channel
+        db_size, files = self._track_size(channel['id'], channel['version'])
+        return {
+            'id': channel['id'],
+            'version': channel['version'],
+            'size': db_size + sum(files.values()),
+        }
+
+    def _track_size(self, channel_id, version):
+        # Returns the size of the channel database and the size of every
+        # file in the channel, indexed by its md5 file id
+        db = self._get_channel_db(channel_id, version)
+        if os.path.isfile(db):
+            return self._get_db_size(db)
+
+        # Only new versions are downloaded, without touching the mirror
+        path = f'/databases/{channel_id}.sqlite3'
+        with self.tempdir() as tempdir:
+            try:
+                db = self._download_content(path, tempdir)
+            except (urllib.error.URLError,
+                    urllib.error.ContentTooShortError,
+                    OSError) as e:
+                raise SourceError(f"{self}: Error tracking {path}: {e}",
+                                  temporary=True) from e
+            return self._get_db_size(db)
+
+    def _get_db_size(self, db):
+        try:
+            with sqlite3.connect(db) as conn:
+                cur = conn.cursor()
+                cur.execute('select id, file_size from content_localfile')
+                files = {row[0]: row[1] or 0 for row in cur}
+        except sqlite3.Error as e:
+            raise SourceError(
+                f'{self}: Cannot read file sizes from {db}: {e}') from e
+        return os.path.getsize(db), files
 
     def _download_content(self, path, dst):
         url = f'{STUDIO}/content{path}'
@@ -107,6 +173,7 @@ class KolibriChannelSource(Source):
             local_file = os.path.join(dst, filename)
             with open(local_file, 'wb') as dest:
                 shutil.copyfileobj(response, dest)
+            return local_file
 
     def _get_channel_db(self, channel_id, version):
         mirror = self._get_mirror_dir(channel_id, version)
@@ -132,20 +199,23 @@ class KolibriChannelSource(Source):
 
         return files
 
-    def _fetch_db(self, channel_id, version):
-        mirror = self._get_mirror_dir(channel_id, version)
-        databases = os.path.join(mirror, 'databases')
-        if not os.path.isdir(databases):
-            os.makedirs(databases)
-
+    def _download_db(self, channel_id, dst):
         path = f'/databases/{channel_id}.sqlite3'
         try:
-            self._download_content(path, databases)
+            return self._download_content(path, dst)
         except (urllib.error.URLError,
                 urllib.error.ContentTooShortError,
                 OSError) as e:
             raise SourceError(f"{self}: Error mirroring {path}: {e}") from e
 
+    def _fetch_db(self, channel_id, version):
+        mirror = self._get_mirror_dir(channel_id, version)
+        databases = os.path.join(mirror, 'databases')
+        if not os.path.isdir(databases):
+            os.makedirs(databases)
+
+        self._download_db(channel_id, databases)
+
     def _fetch_files(self, channel_id, version):
         mirror = self._get_mirror_dir(channel_id, version)
         storage = os.path.join(mirror, 'storage')
@@ -173,7 +243,74 @@ class KolibriChannelSource(Source):
         if not os.path.exists(dbdir):
             os.makedirs(dbdir)
 
-        shutil.copy(self._get_channel_db(channel_id, version), dbdir)
+        if self.optimize_db:
+            db = self._get_optimized_db(channel_id, version)
+        else:
+            db = self._get_channel_db(channel_id, version)
+        shutil.copy(db, dbdir)
+
+    def _get_optimized_db(self, channel_id, version):
+        # The optimized copy is kept in the mirror next to the original
+        # so it is only created once per channel version
+        mirror = self._get_mirror_dir(channel_id, version)
+        optimized = os.path.join(mirror, f'optimized-{OPTIMIZE_VERSION}')
+        db = os.path.join(optimized, f'{channel_id}.sqlite3')
+        if os.path.isfile(db):
+            return db
+
+        if not os.path.isdir(optimized):
+            os.makedirs(optimized)
+
+        with self.timed_activity(f'Optimizing database {channel_id}'):
+            tmp = f'{db}.{os.getpid()}.tmp'
+            try:
+                shutil.copy(self._get_channel_db(channel_id, version), tmp)
+                self._optimize_db(tmp)
+                os.replace(tmp, db)
+            except (sqlite3.Error, OSError) as e:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise SourceError(
+                    f'{self}: Error optimizing database {channel_id}: {e}'
+                ) from e
+
+        return db
+
+    def _optimize_db(self, path):
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            cur = conn.cursor()
+            columns = {}
+            for name, table, index_columns in OPTIMIZE_INDEXES:
+                if table not in columns:
+                    cur.execute(f'pragma table_info({table})')
+                    columns[table] = {row[1] for row in cur}
+                # Older channel databases can lack some of the columns
+                if not set(index_columns) <= columns[table]:
+                    continue
+                if self._has_index(cur, table, index_columns):
+                    continue
+                cur.execute(f'create index if not exists {name} '
+                            f'on {table} ({", ".join(index_columns)})')
+
+            cur.execute('analyze')
+            # The page size only changes on vacuum, and not in WAL mode
+            cur.execute('pragma journal_mode = delete')
+            cur.execute(f'pragma page_size = {OPTIMIZE_PAGE_SIZE}')
+            cur.execute('vacuum')
+        finally:
+            conn.close()
+
+    def _has_index(self, cur, table, columns):
+        # An index starting with the same columns already serves the
+        # same queries, a new one would only make the database bigger
+        cur.execute(f'pragma index_list({table})')
+        for index in [row[1] for row in cur.fetchall()]:
+            cur.execute(f'pragma index_info("{index}")')
+            existing = [row[2] for row in sorted(cur.fetchall())]
+            if existing[:len(columns)] == columns:
+                return True
+        return False
 
     def _stage_files(self, directory, channel_id, version):
         mirror = self._get_mirror_dir(channel_id, version)
@@ -26,11 +26,13 @@ from hashlib import sha256
 from dataclasses import dataclass
 from buildstream import Source, SourceError, utils, Consistency
 from .kolibri_channel import KolibriChannelSource, STUDIO, API, SourceFile
+from .kolibri_channel import OPTIMIZE_VERSION
 
 
 class KolibriCollectionSource(KolibriChannelSource):
     def configure(self, node):
-        self.node_validate(node, ['token', 'ref', 'channels'] +
+        self.node_validate(node, ['token', 'ref', 'channels', 'size',
+                                  'optimize_db'] +
                            Source.COMMON_CONFIG_KEYS)
 
         self.load_ref(node)
@@ -40,6 +42,8 @@ class KolibriCollectionSource(KolibriChannelSource):
 
         self.ref = self.node_get_member(node, str, 'ref', None)
         self.channels = self.node_get_member(node, list, 'channels', None)
+        self.optimize_db = self.node_get_member(node, bool, 'optimize_db',
+                                                False)
 
     def calculate_hash(self, channels):
         # The hash is a sha256sum of the string formed with all the
@@ -51,23 +55,32 @@ class KolibriCollectionSource(KolibriChannelSource):
         pass
 
     def get_unique_key(self):
-        return [self.token, self.ref]
+        key = [self.token, self.ref]
+        if self.optimize_db:
+            key.append(f'optimize-db-{OPTIMIZE_VERSION}')
+        return key
 
     def load_ref(self, node):
         self.ref = self.node_get_member(node, str, 'ref', None)
         self.channels = self.node_get_member(node, list, 'channels', None)
+        self.size = self.node_get_member(node, int, 'size', None)
 
     def get_ref(self):
         if self.ref is None or self.channels is None:
             return None
-        return {
+        ref = {
             'ref': self.ref,
             'channels': self.channels,
         }
+        if self.size is not None:
+            ref['size'] = self.size
+        return ref
 
     def set_ref(self, ref, node):
         node['ref'] = self.ref = ref['ref']
         node['channels'] = self.channels = ref['channels']
+        if 'size' in ref:
+            node['size'] = self.size = ref['size']
 
     def track(self):
         studio_api = STUDIO + API + self.token
@@ -83,13 +96,25 @@ class KolibriCollectionSource(KolibriChannelSource):
                 f'{self}: Cannot find any collection for {lookup}')
 
         channels = []
+        # Channels share files, those are staged only once
+        files = {}
+        size = 0
         for c in payload:
-            channel = { 'id': c['id'], 'version': c['version'] }
+            db_size, channel_files = self._track_size(c['id'],
+                                                      c['version'])
+            channel = {
+                'id': c['id'],
+                'version': c['version'],
+                'size': db_size + sum(channel_files.values()),
+            }
             channels.append(channel)
+            files.update(channel_files)
+            size += db_size
 
         return {
             'ref': self.calculate_hash(channels),
             'channels': channels,
+            'size': size + sum(files.values()),
         }
 
     def fetch(self):
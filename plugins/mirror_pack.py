@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+#
+#  Copyright EndlessOS Foundation
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  Authors:
+#        Daniel Garcia <danigm@endlessos.org>
+
+"""Export and import the source mirrors of the local plugins as packs.
+
+A snapshot is a directory with a few large pack files and an
+``index.json``. Every file is stored once in the packs, addressed by its
+sha256, and the index maps the mirror paths to the stored content.
+
+    $ python3 plugins/mirror_pack.py export snapshot/
+    $ python3 plugins/mirror_pack.py import snapshot/
+"""
+
+import os
+import sys
+import json
+import mmap
+import shutil
+import contextlib
+import hashlib
+import argparse
+import tempfile
+
+# Source kinds with a mirror directory in the buildstream sources dir
+KINDS = ('kolibri_channel', 'kolibri_collection', 'github_release', 'pypi')
+
+INDEX = 'index.json'
+INDEX_VERSION = 1
+PACK_SIZE = 1024 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+class PackError(Exception):
+    pass
+
+
+def default_sourcedir():
+    cache = os.environ.get('XDG_CACHE_HOME',
+                           os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache, 'buildstream', 'sources')
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _walk_mirrors(sourcedir):
+    # Yields (relative path, is_dir) for every file and every empty
+    # directory in the mirrors, in a stable order
+    for kind in KINDS:
+        top = os.path.join(sourcedir, kind)
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            rel = os.path.relpath(root, sourcedir)
+            if not dirs and not files:
+                yield rel, True
+            for name in sorted(files):
+                yield os.path.join(rel, name), False
+
+
+class PackWriter:
+    def __init__(self, outdir, pack_size):
+        self.outdir = outdir
+        self.pack_size = pack_size
+        self.packs = []
+        self.blobs = {}
+        self._file = None
+
+    def _open(self):
+        fd, path = tempfile.mkstemp(dir=self.outdir, suffix='.pack.tmp')
+        # mkstemp files are private, packs are shared between runners
+        os.fchmod(fd, 0o644)
+        self._file = os.fdopen(fd, 'wb')
+        self._path = path
+        self._hash = hashlib.sha256()
+        self._blobs = {}
+
+    def _close(self):
+        self._file.close()
+        # Packs are named by their own content
+        name = f'pack-{self._hash.hexdigest()}.pack'
+        os.replace(self._path, os.path.join(self.outdir, name))
+        self.packs.append(name)
+        for sha, (offset, length) in self._blobs.items():
+            self.blobs[sha] = [name, offset, length]
+        self._file = None
+
+    def add(self, path, sha):
+        if sha in self.blobs or (self._file and sha in self._blobs):
+            return
+
+        if self._file is None:
+            self._open()
+
+        offset = self._file.tell()
+        with open(path, 'rb') as src:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                self._file.write(chunk)
+                self._hash.update(chunk)
+        self._blobs[sha] = (offset, self._file.tell() - offset)
+
+        if self._file.tell() >= self.pack_size:
+            self._close()
+
+    def finish(self):
+        if self._file is not None:
+            self._close()
+
+
+def export_packs(sourcedir, outdir, pack_size=PACK_SIZE):
+    os.makedirs(outdir, exist_ok=True)
+    if os.path.exists(os.path.join(outdir, INDEX)):
+        raise PackError(f'{outdir} already contains a snapshot')
+
+    writer = PackWriter(outdir, pack_size)
+    files = []
+    dirs = []
+    for rel, is_dir in _walk_mirrors(sourcedir):
+        if is_dir:
+            dirs.append(rel)
+            continue
+        path = os.path.join(sourcedir, rel)
+        sha = _sha256(path)
+        writer.add(path, sha)
+        files.append({
+            'path': rel,
+            'sha256': sha,
+            'mode': os.stat(path).st_mode & 0o777,
+        })
+    writer.finish()
+
+    index = {
+        'version': INDEX_VERSION,
+        'packs': writer.packs,
+        'blobs': writer.blobs,
+        'files': files,
+        'dirs': dirs,
+    }
+    with open(os.path.join(outdir, INDEX), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+def _load_index(packdir):
+    try:
+        with open(os.path.join(packdir, INDEX)) as f:
+            index = json.load(f)
+    except (OSError, ValueError) as e:
+        raise PackError(f'Cannot read {INDEX} in {packdir}: {e}') from e
+
+    if index.get('version') != INDEX_VERSION:
+        raise PackError(f'Unsupported snapshot version in {packdir}')
+
+    for entry in index['files'] + [{'path': d} for d in index['dirs']]:
+        path = os.path.normpath(entry['path'])
+        if os.path.isabs(path) or path.split(os.sep)[0] not in KINDS:
+            raise PackError(f'Invalid path {entry["path"]} in {packdir}')
+
+    used = {entry['sha256'] for entry in index['files']}
+    missing = used - index['blobs'].keys()
+    if missing:
+        raise PackError(f'Missing blob {missing.pop()} in {packdir}')
+    unused = index['blobs'].keys() - used
+    if unused:
+        raise PackError(f'Blob {unused.pop()} in {packdir} is not used')
+
+    return index
+
+
+@contextlib.contextmanager
+def _map_pack(path):
+    with open(path, 'rb') as f:
+        # Empty files cannot be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def _write_blob(data, offset, length, dst, mode):
+    # Returns the sha256 of the written content. The blob is written in
+    # chunks so it is never fully loaded in memory.
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    h = hashlib.sha256()
+    with memoryview(data) as view, open(dst, 'wb') as f:
+        end = offset + length
+        for start in range(offset, end, CHUNK_SIZE):
+            chunk = view[start:min(start + CHUNK_SIZE, end)]
+            h.update(chunk)
+            f.write(chunk)
+    os.chmod(dst, mode)
+    return h.hexdigest()
+
+
+def _link_or_copy(src, dst, mode):
+    # Hardlinks share the mode, files with another mode get their copy
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.stat(src).st_mode & 0o777 == mode:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    os.chmod(dst, mode)
+
+
+def import_packs(packdir, sourcedir):
+    index = _load_index(packdir)
+
+    paths = {}
+    for entry in index['files']:
+        paths.setdefault(entry['sha256'], []).append(entry)
+
+    os.makedirs(sourcedir, exist_ok=True)
+    imported = 0
+    with tempfile.TemporaryDirectory(dir=sourcedir,
+                                     prefix='.mirror-pack-') as tmpdir:
+        for rel in index['dirs']:
+            os.makedirs(os.path.join(tmpdir, rel), exist_ok=True)
+
+        # Read every pack once from start to end, each blob is written to
+        # its first path and the other copies are hardlinked to it
+        by_pack = {}
+        for sha, (pack, offset, length) in index['blobs'].items():
+            by_pack.setdefault(pack, []).append((offset, length, sha))
+
+        for pack in index['packs']:
+            blobs = sorted(by_pack.get(pack, []))
+            if not blobs:
+                continue
+            with _map_pack(os.path.join(packdir, pack)) as data:
+                for offset, length, sha in blobs:
+                    if offset + length > len(data):
+                        raise PackError(f'{pack} is truncated')
+                    first, *others = paths.get(sha, [])
+                    src = os.path.join(tmpdir, first['path'])
+                    written = _write_blob(data, offset, length, src,
+                                          first['mode'])
+                    if written != sha:
+                        raise PackError(f'{pack} is corrupted, blob {sha} '
+                                        f'has sha256 {written}')
+                    for entry in others:
+                        _link_or_copy(src, os.path.join(tmpdir, entry['path']),
+                                      entry['mode'])
+
+        # Move every mirror entry into place only once it is complete, so
+        # an interrupted import never leaves a partial mirror behind
+        for kind in os.listdir(tmpdir):
+            for name in os.listdir(os.path.join(tmpdir, kind)):
+                mirror = os.path.join(kind, name)
+                for entry in os.listdir(os.path.join(tmpdir, mirror)):
+                    dst = os.path.join(sourcedir, mirror, entry)
+                    if os.path.exists(dst):
+                        continue
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.rename(os.path.join(tmpdir, mirror, entry), dst)
+                    imported += 1
+
+    return imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export and import source mirror snapshots')
+    parser.add_argument('--sourcedir', default=default_sourcedir(),
+                        help='buildstream sources directory '
+                             '(default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser(
+        'export', help='Export the mirrors into a snapshot')
+    export_parser.add_argument('packdir')
+    export_parser.add_argument('--pack-size', type=int, default=PACK_SIZE,
+                               help='pack size in bytes (default: '
+                                    '%(default)s)')
+
+    import_parser = subparsers.add_parser(
+        'import', help='Import a snapshot into the mirrors')
+    import_parser.add_argument('packdir')
+
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'export':
+            index = export_packs(args.sourcedir, args.packdir,
+                                 args.pack_size)
+            print(f'Exported {len(index["files"])} files into '
+                  f'{len(index["packs"])} packs')
+        else:
+            imported = import_packs(args.packdir, args.sourcedir)
+            print(f'Imported {imported} mirror entries')
+    except (PackError, OSError) as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
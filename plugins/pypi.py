@@ -64,7 +64,7 @@ class PyPISource(Source):
     def configure(self, node):
         self.node_validate(node, ['url', 'name', 'sha256sum',
                                   'include', 'exclude', 'index',
-                                  'scheme', 'match_pattern'] +
+                                  'scheme', 'match_pattern', 'size'] +
                            Source.COMMON_CONFIG_KEYS)
 
         self.load_ref(node)
@@ -97,16 +97,22 @@ class PyPISource(Source):
             self.url = self.translate_url(self.original_url)
         else:
             self.url = None
+        self.size = self.node_get_member(node, int, 'size', None)
 
     def get_ref(self):
         if self.original_url is None or self.sha256sum is None:
             return None
-        return {'url': self.original_url,
-                'sha256sum': self.sha256sum}
+        ref = {'url': self.original_url,
+               'sha256sum': self.sha256sum}
+        if self.size is not None:
+            ref['size'] = self.size
+        return ref
 
     def set_ref(self, ref, node):
         node['url'] = self.original_url = ref['url']
         node['sha256sum'] = self.sha256sum = ref['sha256sum']
+        if 'size' in ref:
+            node['size'] = self.size = ref['size']
 
     def track(self):
         payload = json.loads(
@@ -137,7 +143,13 @@ class PyPISource(Source):
                 found_ref = {
                     'sha256sum': url['digests']['sha256'],
                     'url': built_url,
+                    'size': url['size'],
                 }
+                if built_url.endswith(('.zip', '.gz')):
+                    # stage() extracts archives, the staged size is the
+                    # extracted one
+                    found_ref['size'] = self._track_extracted_size(
+                        url['url'], found_ref['sha256sum'])
                 break
 
         if found_ref is None:
@@ -172,23 +184,65 @@ class PyPISource(Source):
     def _get_mirror_file(self, sha=None):
         return os.path.join(self._get_mirror_dir(), sha or self.sha256sum)
 
+    def _track_extracted_size(self, url, sha256sum):
+        # The archive is downloaded into the mirror, like fetch does, so
+        # it is not downloaded again to build
+        mirror_file = self._get_mirror_file(sha256sum)
+        if os.path.isfile(mirror_file):
+            return self._get_extracted_size(mirror_file, url)
+
+        try:
+            with self.tempdir() as tempdir:
+                local_file = self._download(url, tempdir)
+                sha256 = utils.sha256sum(local_file)
+                if sha256 != sha256sum:
+                    raise SourceError(
+                        f'{self}: {url} has sha256 {sha256}, '
+                        f'expected {sha256sum}')
+                # Broken archives never reach the mirror
+                size = self._get_extracted_size(local_file, url)
+                if not os.path.isdir(self._get_mirror_dir()):
+                    os.makedirs(self._get_mirror_dir())
+                os.rename(local_file, mirror_file)
+                return size
+        except (urllib.error.URLError,
+                urllib.error.ContentTooShortError, OSError) as e:
+            raise SourceError(f"{self}: Error tracking {url}: {e}",
+                              temporary=True) from e
+
+    def _get_extracted_size(self, path, url):
+        try:
+            if url.endswith('.zip'):
+                with zipfile.ZipFile(path, mode='r') as zipf:
+                    return sum(info.file_size for info in zipf.infolist())
+            with tarfile.open(path, 'r:gz') as tar:
+                return sum(member.size for member in tar.getmembers()
+                           if member.isfile())
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            raise SourceError(f'{self}: Cannot read archive {url}: {e}') from e
+
+    def _download(self, url, directory):
+        default_name = os.path.basename(url)
+        request = urllib.request.Request(url)
+        request.add_header('Accept', '*/*')
+        request.add_header('User-Agent', 'BuildStream/1')
+
+        urlopen = urllib.request.urlopen(request)
+        with contextlib.closing(urlopen) as response:
+            info = response.info()
+            filename = info.get_filename(default_name)
+            filename = os.path.basename(filename)
+            local_file = os.path.join(directory, filename)
+            with open(local_file, 'wb') as dest:
+                shutil.copyfileobj(response, dest)
+
+        return local_file
+
     def fetch(self):
         # More or less copied from _downloadablefilesource.py
         try:
             with self.tempdir() as tempdir:
-                default_name = os.path.basename(self.url)
-                request = urllib.request.Request(self.url)
-                request.add_header('Accept', '*/*')
-                request.add_header('User-Agent', 'BuildStream/1')
-
-                urlopen = urllib.request.urlopen(request)
-                with contextlib.closing(urlopen) as response:
-                    info = response.info()
-                    filename = info.get_filename(default_name)
-                    filename = os.path.basename(filename)
-                    local_file = os.path.join(tempdir, filename)
-                    with open(local_file, 'wb') as dest:
-                        shutil.copyfileobj(response, dest)
+                local_file = self._download(self.url, tempdir)
 
                 if not os.path.isdir(self._get_mirror_dir()):
                     os.makedirs(self._get_mirror_dir())